@@ -117,6 +117,7 @@ echo "[9] Removing configuration files..."
 rm -f /etc/wifi_manager_ap.conf
 rm -f /etc/NetworkManager/conf.d/wifi-country.conf
 rm -f /etc/NetworkManager/conf.d/wifi-powersave.conf
+rm -f /etc/NetworkManager/dnsmasq-shared.d/pifi-captive-dns.conf
 echo "  ✓ Configuration files removed"
 
 # Clean up any leftover files
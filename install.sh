@@ -19,6 +19,9 @@ echo ""
 AP_SSID="${AP_SSID:-PiConfigAP}"
 AP_PASSWORD="${AP_PASSWORD:-}"
 COUNTRY="${COUNTRY:-AU}"
+CAPTIVE_DNS="${CAPTIVE_DNS:-no}"
+PRECOMPUTE_PSK="${PRECOMPUTE_PSK:-no}"
+TRACE_ROUTE="${TRACE_ROUTE:-no}"
 
 # Check root
 if [ "$EUID" -ne 0 ]; then 
@@ -76,6 +79,24 @@ chmod +x /usr/local/bin/config_portal.py
 # Update AP SSID in the script
 sed -i "s/AP_SSID = \"PiConfigAP\"/AP_SSID = \"${AP_SSID}\"/" /usr/local/bin/wifi_manager.py
 
+# Enable the built-in wildcard DNS responder if requested
+if [ "$CAPTIVE_DNS" = "yes" ]; then
+    sed -i "s/^CAPTIVE_DNS = False/CAPTIVE_DNS = True/" /usr/local/bin/wifi_manager.py
+    echo -e "${GREEN}Captive DNS enabled${NC}"
+fi
+
+# Store derived WPA PSKs instead of passphrases if requested
+if [ "$PRECOMPUTE_PSK" = "yes" ]; then
+    sed -i "s/^PRECOMPUTE_PSK = False/PRECOMPUTE_PSK = True/" /usr/local/bin/wifi_manager.py /usr/local/bin/config_portal.py
+    echo -e "${GREEN}Precomputed WPA PSKs enabled${NC}"
+fi
+
+# Serve /debug/trace from the portal if requested
+if [ "$TRACE_ROUTE" = "yes" ]; then
+    sed -i "s/^TRACE_ROUTE = False/TRACE_ROUTE = True/" /usr/local/bin/config_portal.py
+    echo -e "${GREEN}Trace download route enabled${NC}"
+fi
+
 # Save AP password if provided
 if [ -n "$AP_PASSWORD" ]; then
     echo "AP_PASSWORD=\"${AP_PASSWORD}\"" > /etc/wifi_manager_ap.conf
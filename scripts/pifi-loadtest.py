@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Load Test Harness for the Configuration Portal
+Runs config_portal.py against an in-memory fake NetworkManager and
+simulates many clients joining the AP at once
+
+Usage:
+    python3 scripts/pifi-loadtest.py --clients 20 --iterations 3 --label baseline
+    python3 scripts/pifi-loadtest.py --mode single --label single-worker
+    python3 scripts/pifi-loadtest.py --set SOME_SETTING=30 --label tuned
+    python3 scripts/pifi-loadtest.py --compare
+
+Each run is appended to the results file (JSON lines) so serving modes and
+portal settings can be compared run to run.
+"""
+import argparse
+import ast
+import http.client
+import json
+import logging
+import os
+import random
+import shlex
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import config_portal  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+
+DEFAULT_RESULTS = "loadtest-results.jsonl"
+
+# Rough timings of the real nmcli calls on a Pi Zero 2 W, in seconds
+BACKEND_LATENCY = {
+    "scan": 2.5,
+    "show": 0.05,
+    "modify": 0.1,
+    "add": 0.3,
+    "delete": 0.2,
+    "up": 8.0,
+    "down": 1.0,
+}
+
+
+class FakeNetworkManager:
+    """In-memory stand-in for nmcli, installed as config_portal.subprocess"""
+    TimeoutExpired = subprocess.TimeoutExpired
+    PIPE = subprocess.PIPE
+
+    def __init__(self, time_scale=1.0, networks=15):
+        self.time_scale = time_scale
+        self.lock = threading.Lock()
+        self.connections = {config_portal.AP_CONNECTION_NAME: "PiConfigAP"}
+        self.active = config_portal.AP_CONNECTION_NAME
+        self.scan = [(f"Network-{i:02d}", random.randint(10, 99)) for i in range(networks)]
+        self.calls = 0
+
+    def _wait(self, op):
+        time.sleep(BACKEND_LATENCY[op] * self.time_scale)
+
+    def _result(self, args, returncode=0, stdout=""):
+        return subprocess.CompletedProcess(args, returncode, stdout=stdout, stderr="" if returncode == 0 else "Error")
+
+    def run(self, args, **kwargs):
+        """Answer the nmcli invocations the portal makes"""
+        if isinstance(args, str):
+            args = shlex.split(args)
+
+        with self.lock:
+            self.calls += 1
+
+        if args[:1] != ["nmcli"]:
+            return self._result(args, 127)
+
+        if "wifi" in args and "list" in args:
+            self._wait("scan")
+            lines = [f"{ssid}:{signal}:WPA2" for ssid, signal in self.scan]
+            return self._result(args, stdout="\n".join(lines) + "\n")
+
+        if args[-2:] == ["device"] and "TYPE,STATE" in args:
+            self._wait("show")
+            state = "connected" if self.active else "disconnected"
+            return self._result(args, stdout=f"wifi:{state}\n")
+
+        if "GENERAL.CONNECTION" in args:
+            self._wait("show")
+            return self._result(args, stdout=f"GENERAL.CONNECTION:{self.active or ''}\n")
+
+        if "802-11-wireless.ssid" in args and "show" in args:
+            self._wait("show")
+            with self.lock:
+                ssid = self.connections.get(args[-1])
+            return self._result(args, 0 if ssid else 10, f"802-11-wireless.ssid:{ssid}\n" if ssid else "")
+
+        if "|" in args:
+            # run() splits without a shell, so a pipeline reaches nmcli as
+            # extra arguments and fails the same way it does on the Pi
+            self._wait("show")
+            return subprocess.CompletedProcess(args, 10, stdout="",
+                                               stderr="Error: | - no such connection profile.")
+
+        if args[1:3] == ["connection", "add"]:
+            self._wait("add")
+            name = args[args.index("con-name") + 1]
+            with self.lock:
+                self.connections[name] = args[args.index("ssid") + 1]
+            return self._result(args)
+
+        if args[1:3] == ["connection", "delete"]:
+            self._wait("delete")
+            with self.lock:
+                found = self.connections.pop(args[3], None) is not None
+            return self._result(args, 0 if found else 10)
+
+        if args[1:3] == ["connection", "modify"]:
+            self._wait("modify")
+            return self._result(args)
+
+        if args[1:3] == ["connection", "up"]:
+            self._wait("up")
+            with self.lock:
+                found = args[3] in self.connections
+                if found:
+                    self.active = args[3]
+            return self._result(args, 0 if found else 10)
+
+        if args[1:3] == ["connection", "down"]:
+            self._wait("down")
+            with self.lock:
+                if self.active == args[3]:
+                    self.active = None
+            return self._result(args)
+
+        return self._result(args, 2)
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class Client(threading.Thread):
+    """One simulated phone: captive probe, page load (which scans), maybe configure"""
+
+    def __init__(self, client_id, port, iterations, configure_ratio, record):
+        super().__init__(daemon=True)
+        self.client_id = client_id
+        self.port = port
+        self.iterations = iterations
+        self.configure_ratio = configure_ratio
+        self.record = record
+        self.rng = random.Random(client_id)
+
+    def request(self, step, method, path, body=None):
+        headers = {"Host": "connectivitycheck.gstatic.com" if step == "probe" else "127.0.0.1"}
+        if body is not None:
+            body = urllib.parse.urlencode(body)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+        start = time.perf_counter()
+        ok = False
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=300)
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            conn.close()
+            ok = response.status < 500
+        except Exception:
+            pass
+        self.record(step, time.perf_counter() - start, ok)
+
+    def run(self):
+        for i in range(self.iterations):
+            self.request("probe", "GET", "/generate_204")
+            self.request("page", "GET", "/")
+            if self.rng.random() < self.configure_ratio:
+                self.request("configure", "POST", "/configure", {
+                    "ssid": f"Home-{self.client_id}-{i}",
+                    "password": "correcthorse",
+                })
+
+
+def parse_setting(text):
+    """Parse NAME=VALUE into a config_portal attribute override"""
+    name, _, value = text.partition("=")
+    if not hasattr(config_portal, name):
+        raise argparse.ArgumentTypeError(f"config_portal has no setting {name}")
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    return name, value
+
+
+def run_load_test(args):
+    """Run one load test and return its result record"""
+    random.seed(args.seed)
+    backend = FakeNetworkManager(time_scale=args.time_scale)
+    config_portal.subprocess = backend
+    # Clients connect over loopback, so treat it as the AP network
+    config_portal.AP_IP = "127.0.0.1/8"
+    for name, value in args.settings:
+        setattr(config_portal, name, value)
+    config_portal.logger.setLevel(logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    server = make_server("127.0.0.1", 0, config_portal.APP, threaded=(args.mode == "threaded"))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    samples = {}
+    samples_lock = threading.Lock()
+
+    def record(step, elapsed, ok):
+        with samples_lock:
+            latencies, errors = samples.setdefault(step, ([], [0]))
+            latencies.append(elapsed)
+            if not ok:
+                errors[0] += 1
+
+    clients = [Client(i, server.server_port, args.iterations, args.configure_ratio, record)
+               for i in range(args.clients)]
+
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    wall_time = time.perf_counter() - start
+    server.shutdown()
+
+    routes = {}
+    for step, (latencies, errors) in sorted(samples.items()):
+        latencies.sort()
+        routes[step] = {
+            "requests": len(latencies),
+            "errors": errors[0],
+            "throughput": round(len(latencies) / wall_time, 2),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        }
+
+    total = sum(route["requests"] for route in routes.values())
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "label": args.label,
+        "mode": args.mode,
+        "clients": args.clients,
+        "iterations": args.iterations,
+        "configure_ratio": args.configure_ratio,
+        "time_scale": args.time_scale,
+        "settings": dict(args.settings),
+        "backend_calls": backend.calls,
+        "wall_time_s": round(wall_time, 2),
+        "throughput": round(total / wall_time, 2),
+        "routes": routes,
+    }
+
+
+def print_result(result):
+    """Print one run as a per-route table"""
+    print(f"\n{result['label'] or '(unlabelled)'} - mode {result['mode']}, "
+          f"{result['clients']} clients x {result['iterations']} iterations, "
+          f"time scale {result['time_scale']}, settings {result['settings'] or '{}'}")
+    print(f"  {result['throughput']} req/s overall, {result['wall_time_s']} s wall time, "
+          f"{result['backend_calls']} backend calls")
+    print(f"  {'route':<14}{'reqs':>6}{'errs':>6}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for step, route in result["routes"].items():
+        print(f"  {step:<14}{route['requests']:>6}{route['errors']:>6}{route['throughput']:>9}"
+              f"{route['p50_ms']:>10}{route['p95_ms']:>10}{route['p99_ms']:>10}")
+
+
+def compare_results(path):
+    """Print every stored run side by side, one line per run and route"""
+    if not os.path.exists(path):
+        print(f"No results in {path}")
+        return 1
+
+    with open(path) as f:
+        results = [json.loads(line) for line in f if line.strip()]
+
+    print(f"{'timestamp':<21}{'label':<18}{'mode':<10}{'route':<14}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for result in results:
+        for step, route in result["routes"].items():
+            print(f"{result['timestamp']:<21}{(result['label'] or '-')[:17]:<18}{result['mode']:<10}{step:<14}"
+                  f"{route['throughput']:>9}{route['p50_ms']:>10}{route['p95_ms']:>10}{route['p99_ms']:>10}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the configuration portal against a fake NetworkManager")
+    parser.add_argument("--clients", type=int, default=10, help="simultaneous clients (default 10)")
+    parser.add_argument("--iterations", type=int, default=3, help="flows per client (default 3)")
+    parser.add_argument("--configure-ratio", type=float, default=0.25,
+                        help="chance a flow ends with a form submission (default 0.25)")
+    parser.add_argument("--mode", choices=["threaded", "single"], default="threaded",
+                        help="threaded matches APP.run(); single serves one request at a time")
+    parser.add_argument("--time-scale", type=float, default=0.1,
+                        help="multiplier for simulated nmcli latencies (default 0.1)")
+    parser.add_argument("--set", dest="settings", action="append", type=parse_setting, default=[],
+                        metavar="NAME=VALUE", help="override a config_portal setting for this run")
+    parser.add_argument("--label", default="", help="name for this run in the results file")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--results", default=DEFAULT_RESULTS, help=f"results file (default {DEFAULT_RESULTS})")
+    parser.add_argument("--compare", action="store_true", help="print stored results and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        return compare_results(args.results)
+
+    result = run_load_test(args)
+    print_result(result)
+
+    with open(args.results, "a") as f:
+        f.write(json.dumps(result) + "\n")
+    print(f"\nSaved to {args.results}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
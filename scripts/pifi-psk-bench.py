@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+WPA PSK Micro-Benchmark
+Measures what a plaintext passphrase costs on every activation compared with
+a precomputed 64-hex-char PSK (PRECOMPUTE_PSK = True)
+
+With a passphrase, wpa_supplicant (client) or the AP side runs 4096 rounds of
+PBKDF2-SHA1 each time the connection comes up. With a stored PSK it only
+decodes 64 hex characters. Run this on the Pi itself to see the saving there.
+
+Usage:
+    python3 scripts/pifi-psk-bench.py
+    python3 scripts/pifi-psk-bench.py --ssid MyNetwork --rounds 50
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from wifi_manager import derive_psk  # noqa: E402
+
+
+def measure(func, rounds):
+    """Return per-call timings in milliseconds"""
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark passphrase vs precomputed WPA PSK")
+    parser.add_argument("--ssid", default="PiConfigAP")
+    parser.add_argument("--passphrase", default="correct horse battery")
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    psk = derive_psk(args.ssid, args.passphrase)
+    if psk is None:
+        print("Passphrase must be 8-63 ASCII characters")
+        return 1
+
+    derive = measure(lambda: derive_psk(args.ssid, args.passphrase), args.rounds)
+    decode = measure(lambda: bytes.fromhex(psk), args.rounds)
+
+    derive_ms = statistics.median(derive)
+    decode_ms = statistics.median(decode)
+
+    print(f"SSID: {args.ssid}, {args.rounds} rounds (median / max)")
+    print(f"  Passphrase (PBKDF2-SHA1 x4096): {derive_ms:8.3f} ms / {max(derive):8.3f} ms")
+    print(f"  Precomputed PSK (hex decode):   {decode_ms:8.3f} ms / {max(decode):8.3f} ms")
+    print(f"  Saving per activation:          {derive_ms - decode_ms:8.3f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
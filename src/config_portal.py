@@ -3,13 +3,18 @@
 WiFi Configuration Portal for Raspberry Pi OS (NetworkManager)
 Web interface for configuring WiFi connections
 """
-from flask import Flask, request, render_template_string, redirect
+from flask import Flask, request, render_template_string, redirect, send_file, abort
 import subprocess
+import ipaddress
 import shlex
 import html
 import os
+import time
 import logging
 
+# install.sh puts both scripts in /usr/local/bin, so wifi_manager is importable
+from wifi_manager import derive_psk
+
 APP = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -17,6 +22,24 @@ logger = logging.getLogger(__name__)
 # Configuration
 AP_CONNECTION_NAME = "pi-hotspot"
 AP_CONFIG_FILE = "/etc/wifi_manager_ap.conf"
+PRECOMPUTE_PSK = False  # Store the derived 256-bit PSK instead of the passphrase
+AP_IP = "192.168.4.1/24"  # Must match AP_IP in wifi_manager.py
+TRACE_FILE = "/run/pifi-trace.json"  # Written by wifi_manager.py on SIGUSR1
+TRACE_ROUTE = False  # Serve /debug/trace to loopback and AP clients
+
+# Connectivity-check URLs probed by phones and laptops right after joining.
+# Anything other than the expected answer makes them open the portal.
+CAPTIVE_PROBE_PATHS = [
+    "/generate_204",               # Android, Chrome OS
+    "/gen_204",                    # Android
+    "/hotspot-detect.html",        # iOS, macOS
+    "/library/test/success.html",  # Older iOS
+    "/connecttest.txt",            # Windows 10+
+    "/ncsi.txt",                   # Older Windows
+    "/redirect",                   # Windows
+    "/canonical.html",             # Firefox
+    "/success.txt",                # Firefox
+]
 
 HTML_FORM = """<!DOCTYPE html>
 <html>
@@ -316,16 +339,42 @@ def scan_networks():
         return []
 
 
-def get_current_ap_ssid():
-    """Get current AP SSID from NetworkManager"""
+def psk_for(ssid: str, passphrase: str) -> str:
+    """Value to store as wifi-sec.psk for this SSID and passphrase"""
+    return (PRECOMPUTE_PSK and derive_psk(ssid, passphrase)) or passphrase
+
+
+def read_ap_password():
+    """Read the saved AP passphrase from AP_CONFIG_FILE"""
+    try:
+        with open(AP_CONFIG_FILE, 'r') as f:
+            for line in f:
+                if line.startswith("AP_PASSWORD="):
+                    return line.split('=', 1)[1].strip().strip('"\'')
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"Error reading AP config: {e}")
+    return None
+
+
+def query_ap_ssid():
+    """Read the AP SSID from NetworkManager, or None if it cannot be read"""
     try:
         result = run(f"nmcli -t -f 802-11-wireless.ssid connection show {AP_CONNECTION_NAME}")
         if result and result.returncode == 0:
-            ssid = result.stdout.strip().split(':')[-1]
-            return ssid if ssid else "PiConfigAP"
+            # Terse output escapes ':' and '\' inside values
+            ssid = result.stdout.strip().partition(':')[2]
+            ssid = ssid.replace('\\:', ':').replace('\\\\', '\\')
+            return ssid or None
     except Exception:
         pass
-    return "PiConfigAP"
+    return None
+
+
+def get_current_ap_ssid():
+    """Get current AP SSID from NetworkManager"""
+    return query_ap_ssid() or "PiConfigAP"
 
 
 def add_wifi_connection(ssid: str, password: str = None):
@@ -355,7 +404,7 @@ def add_wifi_connection(ssid: str, password: str = None):
         if password:
             cmd_parts.extend([
                 "wifi-sec.key-mgmt", "wpa-psk",
-                "wifi-sec.psk", password
+                "wifi-sec.psk", psk_for(ssid, password)
             ])
         else:
             # Open network
@@ -415,8 +464,16 @@ def update_ap_settings(ssid: str = None, password: str = None):
         
         # Update password
         if password and len(password) >= 8:
+            # The derived key is salted with the SSID, so it must be the real one
+            key_ssid = ssid or (PRECOMPUTE_PSK and query_ap_ssid())
+            if key_ssid:
+                psk = psk_for(key_ssid, password)
+            else:
+                if PRECOMPUTE_PSK:
+                    logger.warning("Cannot read AP SSID - storing the plain passphrase instead of a derived PSK")
+                psk = password
             run(f"nmcli connection modify {AP_CONNECTION_NAME} wifi-sec.key-mgmt wpa-psk")
-            run(f"nmcli connection modify {AP_CONNECTION_NAME} wifi-sec.psk '{password}'")
+            run(f"nmcli connection modify {AP_CONNECTION_NAME} wifi-sec.psk '{psk}'")
             # Save password to config file
             try:
                 with open(AP_CONFIG_FILE, 'w') as f:
@@ -426,6 +483,11 @@ def update_ap_settings(ssid: str = None, password: str = None):
                 logger.error(f"Failed to save AP password: {e}")
         elif password:
             logger.warning("AP password too short (must be 8+ characters)")
+        elif ssid:
+            # A derived PSK is salted with the SSID, so re-derive it for the new name
+            saved_password = read_ap_password()
+            if saved_password and len(saved_password) >= 8:
+                run(f"nmcli connection modify {AP_CONNECTION_NAME} wifi-sec.psk '{psk_for(ssid, saved_password)}'")
         
         # Restart AP connection if it's active
         result = run(f"nmcli connection show --active | grep {AP_CONNECTION_NAME}")
@@ -443,8 +505,6 @@ def update_ap_settings(ssid: str = None, password: str = None):
 
 @APP.route("/")
 @APP.route("/index.html")
-@APP.route("/generate_204")  # Android captive portal detection
-@APP.route("/hotspot-detect.html")  # iOS captive portal detection
 def index():
     """Main configuration page"""
     networks = scan_networks()
@@ -452,6 +512,42 @@ def index():
     return render_template_string(HTML_FORM, networks=networks, current_ap=current_ap)
 
 
+def is_ap_client() -> bool:
+    """True if the request came from a client joined to the Pi's AP"""
+    try:
+        return ipaddress.ip_address(request.remote_addr) in ipaddress.ip_interface(AP_IP).network
+    except ValueError:
+        return False
+
+
+def portal_redirect():
+    """Redirect to the portal on the AP address"""
+    return redirect(f"http://{AP_IP.split('/')[0]}/", code=302)
+
+
+def captive_probe():
+    """Send connectivity checks from AP clients straight to the portal"""
+    if not is_ap_client():
+        abort(404)
+    return portal_redirect()
+
+
+for _path in CAPTIVE_PROBE_PATHS:
+    APP.add_url_rule(_path, endpoint=f"probe{_path}", view_func=captive_probe)
+
+
+@APP.errorhandler(404)
+def catch_all(e):
+    """Redirect AP clients asking for other hosts (wildcard DNS) to the portal
+
+    On the home LAN, or for unknown paths on the portal host itself, this
+    stays a normal 404.
+    """
+    if is_ap_client() and request.host.split(':')[0] != AP_IP.split('/')[0]:
+        return portal_redirect()
+    return e
+
+
 @APP.route("/configure", methods=["POST"])
 def configure():
     """Handle configuration form submission"""
@@ -471,6 +567,9 @@ def configure():
         if ap_ssid or ap_pass:
             update_ap_settings(ap_ssid if ap_ssid else None, ap_pass if ap_pass else None)
         
+        # Have the WiFi Manager drop whatever it is doing and re-check state now
+        run("systemctl kill --signal=SIGUSR2 --kill-who=main wifi-manager.service")
+        
         return render_template_string(
             HTML_RESULT,
             ssid=html.escape(ssid if ssid else "(unchanged)"),
@@ -498,6 +597,36 @@ def status():
         return {"status": "error", "message": str(e)}, 500
 
 
+def debug_trace():
+    """Dump the WiFi Manager's trace buffer as Chrome trace / Perfetto JSON"""
+    # Traces list connection names and nmcli commands - keep them off the LAN
+    if not (request.remote_addr == "127.0.0.1" or is_ap_client()):
+        abort(404)
+    
+    before = os.path.getmtime(TRACE_FILE) if os.path.exists(TRACE_FILE) else 0
+    
+    # Only signal the main process - nmcli children would die from SIGUSR1
+    run("systemctl kill --signal=SIGUSR1 --kill-who=main wifi-manager.service")
+    
+    deadline = time.time() + 3
+    fresh = False
+    while time.time() < deadline and not fresh:
+        fresh = os.path.exists(TRACE_FILE) and os.path.getmtime(TRACE_FILE) > before
+        if not fresh:
+            time.sleep(0.1)
+    
+    # An older dump must not be passed off as the current trace
+    if not fresh:
+        return {"status": "error", "message": "No new trace written - is wifi-manager running with PIFI_TRACE=1?"}, 503
+    
+    return send_file(TRACE_FILE, mimetype="application/json", as_attachment=True,
+                     download_name="pifi-trace.json", max_age=0)
+
+
+if TRACE_ROUTE:
+    APP.add_url_rule("/debug/trace", view_func=debug_trace)
+
+
 if __name__ == "__main__":
     # Ensure running as root
     if os.geteuid() != 0:
@@ -4,7 +4,19 @@ WiFi Manager for Raspberry Pi OS (NetworkManager)
 Automatically switches between AP mode and client mode
 """
 import os
+import sys
+import collections
+import contextlib
+import functools
+import hashlib
+import json
+import select
+import signal
+import socket
+import socketserver
+import struct
 import subprocess
+import threading
 import time
 import shlex
 import logging
@@ -15,6 +27,45 @@ AP_CONNECTION_NAME = "pi-hotspot"
 WLAN_IF = "wlan0"
 AP_IP = "192.168.4.1/24"
 CHECK_INTERVAL = 10  # seconds
+PRECOMPUTE_PSK = False  # Store the derived 256-bit PSK instead of the passphrase
+AUTO_CHANNEL = True  # Pick the least congested channel whenever the AP starts
+AP_ALLOW_5GHZ = True  # Consider 5 GHz channels if the adapter supports them
+
+CAPTIVE_DNS = False  # Answer every DNS query with the AP address while in AP mode
+CAPTIVE_DNS_PORT = 53
+CAPTIVE_DNS_TTL = 5  # seconds, short so clients re-resolve once the AP is gone
+CAPTIVE_DNS_MAX_FAILURES = 3  # AP-mode ticks the responder may fail to bind before dnsmasq takes DNS back
+DNSMASQ_SHARED_CONF = "/etc/NetworkManager/dnsmasq-shared.d/pifi-captive-dns.conf"
+TRACE_ENABLED = os.environ.get("PIFI_TRACE") == "1"  # Opt-in span tracing
+TRACE_BUFFER_SIZE = 20000  # events kept in memory, oldest dropped first
+TRACE_FILE = "/run/pifi-trace.json"  # Written on SIGUSR1
+COMMAND_TIMEOUT = 30  # seconds, upper bound for any single command
+
+# Time budgets in seconds. The longest tick is the periodic retry in AP mode:
+# state checks, stop_ap, try_connect_wifi, then start_ap to restore the AP.
+# start_ap runs last, so the sum must fit in TICK_BUDGET or the AP restore is
+# starved and the Pi is left with neither a client connection nor an AP.
+#   state checks (2-3 nmcli queries)                              10
+#   STOP_AP_BUDGET     connection down                            15
+#   CONNECT_BUDGET     one full activation (30) plus a retry      45
+#   START_AP_BUDGET    profile (20) + disconnect/settle (5)
+#                      + channel scan (15) + activation (30)      75
+#   total                                                        145 <= 150
+# WatchdogSec in wifi-manager.service must exceed TICK_BUDGET + CHECK_INTERVAL.
+TICK_BUDGET = 150
+STOP_AP_BUDGET = 15
+CONNECT_BUDGET = 45
+START_AP_BUDGET = 75
+CREATE_AP_BUDGET = 20  # Part of START_AP_BUDGET, includes duplicate cleanup
+CHANNEL_SELECT_BUDGET = 15  # Part of START_AP_BUDGET
+
+# Candidate AP channels per NetworkManager band, in order of preference on ties.
+# 2.4 GHz uses the non-overlapping channels; 5 GHz sticks to UNII-1, which
+# allows AP mode without DFS in practically every regulatory domain.
+AP_CHANNELS = {
+    "bg": [1, 6, 11],
+    "a": [36, 40, 44, 48],
+}
 
 # Setup logging
 logging.basicConfig(
@@ -24,27 +75,342 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def run(cmd: str, check=False):
-    """Run a shell command and return result"""
+class Tracer:
+    """Bounded in-memory span recorder, exported as Chrome trace JSON
+
+    The output loads directly in Perfetto (ui.perfetto.dev) or chrome://tracing.
+    """
+
+    def __init__(self, size: int):
+        self.events = collections.deque(maxlen=size)
+        self.thread_names = {}
+        self.pid = os.getpid()
+
+    def _tid(self) -> int:
+        # Names are captured as events are recorded so export never has to
+        # walk threading.enumerate(), which takes threading's internal lock
+        thread = threading.current_thread()
+        self.thread_names[thread.ident] = thread.name
+        return thread.ident
+
+    @contextlib.contextmanager
+    def span(self, name: str, cat: str, args: dict):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.events.append({
+                "name": name, "cat": cat, "ph": "X",
+                "ts": start / 1000, "dur": (time.perf_counter_ns() - start) / 1000,
+                "pid": self.pid, "tid": self._tid(), "args": args,
+            })
+
+    def instant(self, name: str, cat: str, args: dict):
+        self.events.append({
+            "name": name, "cat": cat, "ph": "i", "s": "p",
+            "ts": time.perf_counter_ns() / 1000,
+            "pid": self.pid, "tid": self._tid(), "args": args,
+        })
+
+    def export(self) -> dict:
+        # deque.copy() and dict() are atomic under the GIL, so this is safe
+        # while the main loop keeps recording
+        events = self.events.copy()
+        threads = [{
+            "name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid,
+            "args": {"name": name},
+        } for tid, name in dict(self.thread_names).items()]
+        return {"traceEvents": threads + list(events), "displayTimeUnit": "ms"}
+
+    def dump(self, path: str):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.export(), f)
+        os.replace(tmp_path, path)
+
+
+_tracer = Tracer(TRACE_BUFFER_SIZE) if TRACE_ENABLED else None
+_NO_SPAN = contextlib.nullcontext()
+
+
+def span(name: str, cat: str, **args):
+    """Context manager timing a block into the trace buffer (no-op when disabled)"""
+    if _tracer is None:
+        return _NO_SPAN
+    return _tracer.span(name, cat, args)
+
+
+def trace_event(name: str, cat: str, **args):
+    """Record a point-in-time event such as a state transition"""
+    if _tracer is not None:
+        _tracer.instant(name, cat, args)
+
+
+def traced(func):
+    """Decorator recording each call of a high-level operation as a span"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _tracer is None:
+            return func(*args, **kwargs)
+        with _tracer.span(func.__name__, "operation", {}):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def dump_trace():
+    """Write the trace buffer to TRACE_FILE"""
+    if _tracer is None:
+        logger.warning("Tracing is disabled - start with PIFI_TRACE=1 to record spans")
+        return
     try:
-        result = subprocess.run(
-            shlex.split(cmd),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            timeout=30
-        )
+        _tracer.dump(TRACE_FILE)
+        logger.info(f"Wrote {len(_tracer.events)} trace events to {TRACE_FILE}")
+    except Exception as e:
+        logger.error(f"Error writing trace: {e}")
+
+
+# SIGUSR1 only writes a byte to this pipe; a worker thread does the dump, so
+# it also works while the main loop is blocked in a command
+_trace_dump_pipe = None
+
+
+def request_trace_dump(signum, frame):
+    """SIGUSR1 handler: wake the trace dump thread (a bare os.write, no locks)"""
+    if _trace_dump_pipe is not None:
+        try:
+            os.write(_trace_dump_pipe[1], b"\0")
+        except OSError:
+            pass  # Pipe full - a dump is already pending
+
+
+def trace_dump_worker():
+    """Dump the trace each time SIGUSR1 arrives"""
+    while True:
+        os.read(_trace_dump_pipe[0], 64)
+        dump_trace()
+
+
+
+# Deadline shared by everything running under the current tick/operation
+# (monotonic seconds, None for unlimited), and the cancellation state for
+# in-flight work. Only the main loop thread runs commands.
+#
+# Signal handlers only set the plain flags below and SIGKILL the running
+# command; they must not take locks (threading.Event, logging, Popen) the
+# interrupted main thread may already hold. Sleeps wake early through the
+# signal wakeup fd instead.
+_deadline = None
+_cancel_requested = False
+_stopping = False
+_current_proc = None
+_wakeup_sockets = None
+
+
+@contextlib.contextmanager
+def deadline(seconds: float):
+    """Limit the enclosed block to `seconds`, never extending an outer deadline"""
+    global _deadline
+    previous = _deadline
+    limit = time.monotonic() + seconds
+    _deadline = limit if previous is None else min(previous, limit)
+    try:
+        yield
+    finally:
+        _deadline = previous
+
+
+def budget(seconds: float):
+    """Decorator giving a high-level operation a total time budget"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with deadline(seconds):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def time_left(limit: float = COMMAND_TIMEOUT) -> float:
+    """Seconds remaining under the current deadline, capped at `limit`"""
+    if _deadline is None:
+        return limit
+    return min(limit, _deadline - time.monotonic())
+
+
+def cancelled() -> bool:
+    """True once a re-evaluation or shutdown has been requested"""
+    return _cancel_requested or _stopping
+
+
+class OperationCancelled(Exception):
+    """Raised at operation boundaries to end a cancelled tick early"""
+
+
+def check_cancelled():
+    """Abandon the current operation if cancellation was requested
+
+    Commands skipped after a cancellation return None like real failures,
+    so this is checked before acting on (or logging) such a failure.
+    """
+    if cancelled():
+        raise OperationCancelled()
+
+
+def drain_wakeups():
+    """Discard pending signal wakeup bytes"""
+    if _wakeup_sockets is None:
+        return
+    try:
+        while _wakeup_sockets[0].recv(64):
+            pass
+    except BlockingIOError:
+        pass
+
+
+def sleep(seconds: float) -> bool:
+    """Sleep up to `seconds`, waking early on cancellation; returns False if cancelled"""
+    end = time.monotonic() + max(0.0, seconds)
+    while not cancelled():
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            return True
+        if _wakeup_sockets is None:
+            time.sleep(min(remaining, 0.5))
+        else:
+            # Any handled signal writes to the wakeup fd, so this returns at once
+            select.select([_wakeup_sockets[0]], [], [], remaining)
+            drain_wakeups()
+    return False
+
+
+def wait(seconds: float) -> bool:
+    """Sleep within the current budget; returns False if cancelled"""
+    with span("sleep", "wait", seconds=seconds):
+        return sleep(time_left(seconds))
+
+
+def cancel_operations():
+    """Abort whatever the main loop is doing (async-signal safe)
+
+    Uses os.kill rather than Popen.kill, which may take Popen's internal
+    lock while the main thread is inside communicate().
+    """
+    global _cancel_requested
+    _cancel_requested = True
+    proc = _current_proc
+    if proc is not None and proc.returncode is None:
+        try:
+            os.kill(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def handle_reevaluate(signum, frame):
+    """SIGUSR2 handler: drop the current operation and re-check state now
+
+    Sent by the configuration portal after new settings are saved.
+    """
+    cancel_operations()
+
+
+def handle_stop(signum, frame):
+    """SIGTERM/SIGINT handler: cancel in-flight work and leave the main loop"""
+    global _stopping
+    _stopping = True
+    cancel_operations()
+
+
+def install_signal_handlers():
+    """Install handlers and route signal wakeups through a socket pair"""
+    global _wakeup_sockets
+    _wakeup_sockets = socket.socketpair()
+    for sock in _wakeup_sockets:
+        sock.setblocking(False)
+    signal.set_wakeup_fd(_wakeup_sockets[1].fileno(), warn_on_full_buffer=False)
+
+    global _trace_dump_pipe
+    _trace_dump_pipe = os.pipe()
+    os.set_blocking(_trace_dump_pipe[1], False)
+    threading.Thread(target=trace_dump_worker, name="trace-dump", daemon=True).start()
+
+    signal.signal(signal.SIGUSR1, request_trace_dump)
+    signal.signal(signal.SIGUSR2, handle_reevaluate)
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+
+
+def sd_notify(state: str):
+    """Send a state update to systemd (no-op when not run under Type=notify)"""
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return
+    if address.startswith("@"):
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(state.encode())
+    except OSError as e:
+        logger.debug(f"sd_notify failed: {e}")
+
+
+def run_args(args, description: str, check=False):
+    """Run a command within the current deadline and return result
+
+    Returns None on failure to run, timeout, cancellation, or when the
+    budget is already spent. `description` is used for logs and traces so
+    secrets in `args` are never printed.
+    """
+    global _current_proc
+    timeout = time_left()
+    if cancelled():
+        logger.debug(f"Skipping command, operation cancelled: {description}")
+        return None
+    if timeout <= 0:
+        logger.warning(f"Skipping command, time budget exhausted: {description}")
+        return None
+
+    try:
+        with span(description, "backend", timeout=round(timeout, 1)):
+            proc = subprocess.Popen(
+                args,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True
+            )
+            _current_proc = proc
+            try:
+                if cancelled():
+                    # Signalled before _current_proc was set, so nothing killed it
+                    proc.kill()
+                stdout, stderr = proc.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.communicate()
+                raise
+            finally:
+                _current_proc = None
+
+        if cancelled():
+            logger.info(f"Command cancelled: {description}")
+            return None
+        result = subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
         if check and result.returncode != 0:
-            logger.error(f"Command failed: {cmd}\nError: {result.stderr}")
+            logger.error(f"Command failed: {description}\nError: {result.stderr}")
         return result
     except subprocess.TimeoutExpired:
-        logger.error(f"Command timed out: {cmd}")
+        logger.error(f"Command timed out after {timeout:.0f}s: {description}")
         return None
     except Exception as e:
-        logger.error(f"Error running command '{cmd}': {e}")
+        logger.error(f"Error running command '{description}': {e}")
         return None
 
 
+def run(cmd: str, check=False):
+    """Run a shell command and return result"""
+    return run_args(shlex.split(cmd), cmd, check)
+
+
 def is_wifi_connected() -> bool:
     """Check if connected to any WiFi network as a client"""
     result = run("nmcli -t -f TYPE,STATE device")
@@ -73,6 +439,7 @@ def is_ap_active() -> bool:
     return False
 
 
+@traced
 def cleanup_duplicate_ap_connections():
     """Remove all existing AP connections to prevent duplicates"""
     removed_count = 0
@@ -91,16 +458,35 @@ def cleanup_duplicate_ap_connections():
     return removed_count
 
 
+def derive_psk(ssid: str, passphrase: str):
+    """Derive the 64-hex-char WPA PSK (PBKDF2-SHA1, 4096 rounds, SSID as salt)
+
+    Returns None if the passphrase is not a valid 8-63 char ASCII WPA
+    passphrase, in which case it should be passed through unchanged.
+    """
+    if not 8 <= len(passphrase) <= 63 or not passphrase.isascii():
+        return None
+    return hashlib.pbkdf2_hmac("sha1", passphrase.encode(), ssid.encode(), 4096, 32).hex()
+
+
+def psk_for(ssid: str, passphrase: str) -> str:
+    """Value to store as wifi-sec.psk for this SSID and passphrase"""
+    return (PRECOMPUTE_PSK and derive_psk(ssid, passphrase)) or passphrase
+
+
 def ap_connection_exists() -> bool:
     """Check if AP connection profile exists"""
     result = run(f"nmcli -t -f NAME connection show {AP_CONNECTION_NAME}")
     return result is not None and result.returncode == 0
 
 
+@traced
+@budget(CREATE_AP_BUDGET)
 def create_ap_connection():
     """Create NetworkManager AP connection (reuse existing or create new)"""
     # First, clean up any duplicate connections
     duplicates = cleanup_duplicate_ap_connections()
+    check_cancelled()
     
     # Now check if one exists (after cleanup, should be 0 or 1)
     if ap_connection_exists():
@@ -138,21 +524,329 @@ def create_ap_connection():
     if ap_password and len(ap_password) >= 8:
         cmd_parts.extend([
             "wifi-sec.key-mgmt", "wpa-psk",
-            "wifi-sec.psk", ap_password
+            "wifi-sec.psk", psk_for(AP_SSID, ap_password)
         ])
     
-    result = subprocess.run(cmd_parts, capture_output=True, text=True)
+    result = run_args(cmd_parts, f"nmcli connection add con-name {AP_CONNECTION_NAME}")
     
-    if result.returncode == 0:
+    if result and result.returncode == 0:
         logger.info("AP connection created successfully")
         return True
     else:
-        logger.error(f"Failed to create AP connection: {result.stderr}")
+        check_cancelled()
+        logger.error(f"Failed to create AP connection: {result.stderr if result else 'command did not run'}")
+        return False
+
+
+def channel_overlap(channel: int, other: int) -> float:
+    """Return how much a network on `other` interferes with `channel` (0.0-1.0)"""
+    if channel <= 14 and other <= 14:
+        # 2.4 GHz channels are 5 MHz apart but 20 MHz wide
+        return max(0.0, 1.0 - abs(channel - other) / 5.0)
+    if channel > 14 and other > 14:
+        if channel == other:
+            return 1.0
+        # Wide (40/80 MHz) networks spill into the rest of their 80 MHz block
+        if (channel - 36) // 16 == (other - 36) // 16:
+            return 0.5
+    return 0.0
+
+
+def score_channels(scan, candidates):
+    """Score candidate AP channels against scan results (lower is better)
+
+    `scan` is a list of (channel, signal) tuples, one per BSSID, with signal
+    in percent as reported by nmcli. `candidates` maps a NetworkManager band
+    to its channels. Each overlapping BSSID adds its overlap to the score,
+    plus the same again weighted by signal, so a strong neighbour counts up
+    to twice as much as a barely audible one.
+
+    Returns a list of (score, band, channel) tuples, best first.
+    """
+    scores = []
+    for band, channels in candidates.items():
+        for channel in channels:
+            score = 0.0
+            for seen_channel, signal in scan:
+                overlap = channel_overlap(channel, seen_channel)
+                score += overlap * (1.0 + signal / 100.0)
+            scores.append((round(score, 3), len(scores), band, channel))
+
+    scores.sort()
+    return [(score, band, channel) for score, _, band, channel in scores]
+
+
+def get_supported_bands():
+    """Return the NetworkManager bands the WiFi adapter supports"""
+    result = run(f"nmcli -t -f WIFI-PROPERTIES.2GHZ,WIFI-PROPERTIES.5GHZ device show {WLAN_IF}")
+    if not result or result.returncode != 0:
+        return ["bg"]
+
+    bands = []
+    for line in result.stdout.splitlines():
+        if line == "WIFI-PROPERTIES.2GHZ:yes":
+            bands.append("bg")
+        elif line == "WIFI-PROPERTIES.5GHZ:yes" and AP_ALLOW_5GHZ:
+            bands.append("a")
+    return bands or ["bg"]
+
+
+def parse_channel_scan(output: str):
+    """Parse `nmcli -t -f CHAN,SIGNAL device wifi list` output into (channel, signal) tuples"""
+    scan = []
+    for line in output.splitlines():
+        chan, _, signal = line.partition(':')
+        if chan.isdigit() and signal.isdigit():
+            scan.append((int(chan), int(signal)))
+    return scan
+
+
+def scan_channels():
+    """Return (channel, signal) for every BSSID NetworkManager can see"""
+    result = run(f"nmcli -t -f CHAN,SIGNAL device wifi list ifname {WLAN_IF} --rescan auto")
+    if not result or result.returncode != 0:
+        return None
+    return parse_channel_scan(result.stdout)
+
+
+@traced
+@budget(CHANNEL_SELECT_BUDGET)
+def select_ap_channel():
+    """Point the AP profile at the least congested supported channel
+
+    Only called while the AP is down, so the radio is free to scan and no
+    connected client gets kicked off by a channel change.
+    """
+    scan = scan_channels()
+    if scan is None:
+        check_cancelled()
+        logger.warning("Channel scan failed - keeping current AP channel")
         return False
 
+    candidates = {band: AP_CHANNELS[band] for band in get_supported_bands()}
+    score, band, channel = score_channels(scan, candidates)[0]
+    logger.info(f"Selected AP channel {channel} (band {band}, score {score}, {len(scan)} BSSIDs seen)")
+
+    result = run(f"nmcli connection modify {AP_CONNECTION_NAME} "
+                 f"802-11-wireless.band {band} 802-11-wireless.channel {channel}")
+    return result is not None and result.returncode == 0
+
+
+def reset_ap_channel():
+    """Let NetworkManager choose the AP band and channel again"""
+    run(f"nmcli connection modify {AP_CONNECTION_NAME} "
+        f"802-11-wireless.channel 0 802-11-wireless.band ''")
+
+
+def build_captive_dns_response(query: bytes, address: str, ttl: int = CAPTIVE_DNS_TTL):
+    """Build a DNS response pointing every name at `address`
+
+    A (and ANY) queries get a single A record. AAAA and other types get an
+    empty NOERROR answer, so clients fall straight back to IPv4 instead of
+    waiting on a timeout. Returns None for packets that should be dropped.
+    """
+    if len(query) < 12:
+        return None
+
+    txid, flags, qdcount = struct.unpack("!HHH", query[:6])
+    if flags & 0x8000 or qdcount != 1:
+        return None  # Not a query, or not something we can answer
+
+    opcode = (flags >> 11) & 0xF
+    rd = flags & 0x0100
+    if opcode != 0:
+        # NOTIMP, no question section
+        return struct.pack("!HHHHHH", txid, 0x8000 | (opcode << 11) | rd | 4, 0, 0, 0, 0)
+
+    # Walk the QNAME labels to find the end of the question
+    pos = 12
+    while pos < len(query) and query[pos] != 0:
+        if query[pos] & 0xC0:
+            return None  # Compression pointers are not valid in a question
+        pos += query[pos] + 1
+    pos += 5  # Terminating zero byte, QTYPE, QCLASS
+    if pos > len(query):
+        return None
+
+    question = query[12:pos]
+    qtype, qclass = struct.unpack("!HH", query[pos - 4:pos])
 
+    answers = b""
+    if qtype in (1, 255) and qclass == 1:
+        answers = struct.pack("!HHHIH", 0xC00C, 1, 1, ttl, 4) + socket.inet_aton(address)
+
+    # QR, AA, RA set; RD echoed from the query
+    header = struct.pack("!HHHHHH", txid, 0x8400 | 0x0080 | rd, 1, 1 if answers else 0, 0, 0)
+    return header + question + answers
+
+
+class CaptiveDNSHandler(socketserver.BaseRequestHandler):
+    """Answer a single UDP DNS query with the captive portal address"""
+
+    def handle(self):
+        data, sock = self.request
+        response = build_captive_dns_response(data, self.server.answer_address)
+        if response:
+            sock.sendto(response, self.client_address)
+
+
+class CaptiveDNSServer(socketserver.ThreadingUDPServer):
+    """Wildcard DNS responder used while the AP is up"""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, bind_address: str, port: int, answer_address: str):
+        self.answer_address = answer_address
+        super().__init__((bind_address, port), CaptiveDNSHandler)
+
+
+_captive_dns_server = None
+
+
+def start_captive_dns():
+    """Start the wildcard DNS responder on the AP address (idempotent)"""
+    global _captive_dns_server
+    if _captive_dns_server:
+        return True
+
+    address = AP_IP.split('/')[0]
+    try:
+        server = CaptiveDNSServer(address, CAPTIVE_DNS_PORT, address)
+    except OSError as e:
+        logger.error(f"Cannot start captive DNS on {address}:{CAPTIVE_DNS_PORT}: {e}")
+        return False
+
+    threading.Thread(target=server.serve_forever, name="captive-dns", daemon=True).start()
+    _captive_dns_server = server
+    logger.info(f"Captive DNS listening on {address}:{CAPTIVE_DNS_PORT}")
+    return True
+
+
+def stop_captive_dns():
+    """Stop the wildcard DNS responder if it is running"""
+    global _captive_dns_server
+    if not _captive_dns_server:
+        return
+
+    _captive_dns_server.shutdown()
+    _captive_dns_server.server_close()
+    _captive_dns_server = None
+    logger.info("Captive DNS stopped")
+
+
+_captive_dns_failures = 0
+_captive_dns_fallback = False  # Set once the responder gave up; dnsmasq keeps DNS until restart
+
+
+def ensure_captive_dns():
+    """Keep the responder running while in AP mode (called every AP-mode tick)
+
+    Binding can fail transiently, e.g. while the AP address is still being
+    configured, so it is retried on later ticks. After CAPTIVE_DNS_MAX_FAILURES
+    attempts the dnsmasq override is removed and the AP reactivated, so
+    clients get NetworkManager's DNS back rather than none at all.
+    """
+    global _captive_dns_failures, _captive_dns_fallback
+    if not CAPTIVE_DNS or _captive_dns_fallback:
+        return
+
+    if start_captive_dns():
+        _captive_dns_failures = 0
+        return
+
+    _captive_dns_failures += 1
+    if _captive_dns_failures < CAPTIVE_DNS_MAX_FAILURES:
+        return
+
+    check_cancelled()
+    logger.error("Captive DNS unavailable - handing DNS back to dnsmasq")
+    _captive_dns_fallback = True
+    configure_shared_dnsmasq()
+    run(f"nmcli connection up {AP_CONNECTION_NAME}")
+
+
+def remove_shared_dnsmasq_conf():
+    """Give DNS back to dnsmasq for any later shared-mode connection"""
+    try:
+        if os.path.exists(DNSMASQ_SHARED_CONF):
+            os.remove(DNSMASQ_SHARED_CONF)
+    except Exception as e:
+        logger.error(f"Error removing {DNSMASQ_SHARED_CONF}: {e}")
+
+
+def configure_shared_dnsmasq():
+    """Hand DNS on the AP over to the captive responder, or back to dnsmasq
+
+    NetworkManager's shared-mode dnsmasq owns port 53 on the AP address.
+    With CAPTIVE_DNS enabled it is told to serve DHCP only and to advertise
+    the AP address as the DNS server. Takes effect on the next AP activation.
+    """
+    if not CAPTIVE_DNS or _captive_dns_fallback:
+        remove_shared_dnsmasq_conf()
+        return
+
+    address = AP_IP.split('/')[0]
+    try:
+        os.makedirs(os.path.dirname(DNSMASQ_SHARED_CONF), exist_ok=True)
+        with open(DNSMASQ_SHARED_CONF, 'w') as f:
+            f.write("# Managed by wifi_manager.py - DNS is answered by the captive DNS responder\n")
+            f.write("port=0\n")
+            f.write(f"dhcp-option=option:dns-server,{address}\n")
+    except Exception as e:
+        logger.error(f"Error writing {DNSMASQ_SHARED_CONF}: {e}")
+
+
+def captive_dns_lookup(name: str, server: str, port: int, qtype: int = 1, timeout: float = 2.0):
+    """Minimal DNS stub client, returns (rcode, [addresses])"""
+    qname = b"".join(bytes([len(label)]) + label.encode() for label in name.strip('.').split('.'))
+    query = struct.pack("!HHHHHH", 0x5049, 0x0100, 1, 0, 0, 0) + qname + b"\0" + struct.pack("!HH", qtype, 1)
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.sendto(query, (server, port))
+        response, _ = sock.recvfrom(512)
+
+    flags, _, ancount = struct.unpack("!HHH", response[2:8])
+    addresses = []
+    pos = len(query)
+    for _ in range(ancount):
+        rtype, _, _, rdlength = struct.unpack("!HHIH", response[pos + 2:pos + 12])
+        if rtype == 1:
+            addresses.append(socket.inet_ntoa(response[pos + 12:pos + 12 + rdlength]))
+        pos += 12 + rdlength
+    return flags & 0xF, addresses
+
+
+def captive_dns_selftest(port: int) -> bool:
+    """Run the responder on localhost:`port` and query it with the stub client"""
+    address = AP_IP.split('/')[0]
+    server = CaptiveDNSServer("127.0.0.1", port, address)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    ok = True
+    try:
+        for name, qtype, expected in [
+            ("connectivitycheck.gstatic.com", 1, [address]),
+            ("captive.apple.com", 1, [address]),
+            ("www.msftconnecttest.com", 28, []),
+        ]:
+            start = time.monotonic()
+            rcode, addresses = captive_dns_lookup(name, "127.0.0.1", port, qtype)
+            elapsed = (time.monotonic() - start) * 1000
+            passed = rcode == 0 and addresses == expected
+            ok = ok and passed
+            print(f"{'OK  ' if passed else 'FAIL'} {name} type {qtype} -> {addresses} ({elapsed:.1f} ms)")
+    finally:
+        server.shutdown()
+        server.server_close()
+    return ok
+
+
+@traced
+@budget(START_AP_BUDGET)
 def start_ap():
     """Activate AP mode"""
+    check_cancelled()
     if is_ap_active():
         logger.debug("AP already active")
         return
@@ -161,23 +855,50 @@ def start_ap():
     
     # Ensure AP connection exists
     if not create_ap_connection():
+        check_cancelled()
         logger.error("Cannot start AP - connection creation failed")
         return
     
     # Deactivate any active WiFi connections
     result = run(f"nmcli device disconnect {WLAN_IF}")
-    time.sleep(2)
+    wait(2)
+    check_cancelled()
+    
+    # Move the AP to the quietest channel while the radio is idle
+    channel_selected = AUTO_CHANNEL and select_ap_channel()
+    check_cancelled()
+    
+    # dnsmasq reads its config when the AP comes up
+    configure_shared_dnsmasq()
     
     # Activate AP
     result = run(f"nmcli connection up {AP_CONNECTION_NAME}")
     if result and result.returncode == 0:
         logger.info(f"AP mode activated: {AP_SSID}")
-    else:
-        logger.error("Failed to activate AP mode")
+        ensure_captive_dns()
+        return
+    check_cancelled()
+    
+    if channel_selected:
+        # The regulatory domain may not allow AP mode on the chosen channel
+        logger.warning("AP activation failed on selected channel - retrying with default channel")
+        reset_ap_channel()
+        result = run(f"nmcli connection up {AP_CONNECTION_NAME}")
+        if result and result.returncode == 0:
+            logger.info(f"AP mode activated: {AP_SSID}")
+            ensure_captive_dns()
+            return
+        check_cancelled()
+    
+    logger.error("Failed to activate AP mode")
 
 
+@traced
+@budget(STOP_AP_BUDGET)
 def stop_ap():
     """Deactivate AP mode"""
+    stop_captive_dns()
+    
     if not is_ap_active():
         return
     
@@ -185,13 +906,17 @@ def stop_ap():
     run(f"nmcli connection down {AP_CONNECTION_NAME}")
 
 
+@traced
+@budget(CONNECT_BUDGET)
 def try_connect_wifi():
     """Try to connect to available known networks"""
+    check_cancelled()
     logger.info("Scanning for known networks...")
     
     # Get list of known WiFi connections (excluding AP)
     result = run("nmcli -t -f NAME,TYPE connection show")
     if not result or result.returncode != 0:
+        check_cancelled()
         return False
     
     wifi_connections = []
@@ -211,77 +936,122 @@ def try_connect_wifi():
         if result and result.returncode == 0:
             logger.info(f"Successfully connected to: {conn_name}")
             return True
-        time.sleep(2)
+        check_cancelled()
+        wait(2)
+        check_cancelled()
     
     return False
 
 
 def main():
     """Main loop"""
+    global _cancel_requested
     logger.info("WiFi Manager starting...")
     logger.info(f"AP SSID: {AP_SSID}")
     logger.info(f"Interface: {WLAN_IF}")
     
+    install_signal_handlers()
+    
     # Ensure AP connection exists
     create_ap_connection()
     
+    sd_notify("READY=1")
+    
     last_state = None
     consecutive_failures = 0
     
-    while True:
-        try:
-            connected = is_wifi_connected()
-            ap_active = is_ap_active()
-            
-            if connected and ap_active:
-                # Connected to WiFi but AP is still on - turn off AP
-                logger.info("WiFi connected - stopping AP")
-                stop_ap()
-                consecutive_failures = 0
-                
-            elif not connected and not ap_active:
-                # Not connected and AP is off
-                consecutive_failures += 1
+    while not _stopping:
+        # A new tick starts with a clean slate and a fresh budget
+        if _cancel_requested:
+            logger.info("Re-evaluation requested - checking state now")
+            trace_event("reevaluate", "state")
+        _cancel_requested = False
+        drain_wakeups()
+        sd_notify("WATCHDOG=1")
+        tick_start = time.monotonic()
+        tick_failures = consecutive_failures
+        
+        with span("tick", "loop", failures=consecutive_failures), deadline(TICK_BUDGET):
+            try:
+                connected = is_wifi_connected()
+                ap_active = is_ap_active()
+                check_cancelled()
                 
-                # Try to connect to known networks first
-                if consecutive_failures <= 2:
-                    logger.info("Attempting to connect to known WiFi...")
-                    if try_connect_wifi():
-                        consecutive_failures = 0
-                        time.sleep(CHECK_INTERVAL)
-                        continue
+                if connected and ap_active:
+                    # Connected to WiFi but AP is still on - turn off AP
+                    logger.info("WiFi connected - stopping AP")
+                    stop_ap()
+                    consecutive_failures = 0
+                    
+                elif not connected and not ap_active:
+                    # Not connected and AP is off
+                    consecutive_failures += 1
+                    
+                    # Try to connect to known networks first
+                    if consecutive_failures <= 2:
+                        logger.info("Attempting to connect to known WiFi...")
+                        if try_connect_wifi():
+                            consecutive_failures = 0
+                            sleep(CHECK_INTERVAL)
+                            continue
+                    
+                    # Start AP if connection attempts fail
+                    logger.info("No WiFi connection - starting AP mode")
+                    start_ap()
+                    consecutive_failures = 0
+                    
+                elif connected and not ap_active:
+                    # All good - connected to WiFi
+                    consecutive_failures = 0
+                    stop_captive_dns()
+                    if last_state != "connected":
+                        logger.info("WiFi connection stable")
+                        
+                elif not connected and ap_active:
+                    # Retried every tick in case the responder failed to bind
+                    ensure_captive_dns()
+                    
+                    # AP is running, periodically try to connect
+                    if consecutive_failures > 0 and consecutive_failures % 6 == 0:  # Every minute
+                        logger.info("Periodic WiFi connection attempt...")
+                        stop_ap()
+                        if try_connect_wifi():
+                            consecutive_failures = 0
+                        else:
+                            start_ap()
+                    consecutive_failures += 1
                 
-                # Start AP if connection attempts fail
-                logger.info("No WiFi connection - starting AP mode")
-                start_ap()
-                consecutive_failures = 0
+                state = "connected" if connected else "ap"
+                if state != last_state:
+                    trace_event(f"{last_state} -> {state}", "state")
+                last_state = state
                 
-            elif connected and not ap_active:
-                # All good - connected to WiFi
-                consecutive_failures = 0
-                if last_state != "connected":
-                    logger.info("WiFi connection stable")
-                    
-            elif not connected and ap_active:
-                # AP is running, periodically try to connect
-                if consecutive_failures > 0 and consecutive_failures % 6 == 0:  # Every minute
-                    logger.info("Periodic WiFi connection attempt...")
-                    stop_ap()
-                    if try_connect_wifi():
-                        consecutive_failures = 0
-                    else:
-                        start_ap()
-                consecutive_failures += 1
-            
-            last_state = "connected" if connected else "ap"
-            
-        except Exception as e:
-            logger.error(f"Error in main loop: {e}")
+            except OperationCancelled:
+                # Nothing was decided this tick; state is re-read on the next one
+                consecutive_failures = tick_failures
+                logger.info("Current operation cancelled")
+            except Exception as e:
+                logger.error(f"Error in main loop: {e}")
         
-        time.sleep(CHECK_INTERVAL)
+        elapsed = time.monotonic() - tick_start
+        if elapsed > TICK_BUDGET:
+            logger.warning(f"Loop tick took {elapsed:.0f}s (budget {TICK_BUDGET}s)")
+        
+        sleep(CHECK_INTERVAL)
+    
+    logger.info("WiFi Manager stopping...")
+    sd_notify("STOPPING=1")
+    stop_captive_dns()
+    # NetworkManager applies dnsmasq-shared.d to every hotspot, not just ours
+    remove_shared_dnsmasq_conf()
 
 
 if __name__ == "__main__":
+    # Local check of the captive DNS responder, no root needed:
+    #   python3 wifi_manager.py --dns-selftest 5353
+    if len(sys.argv) == 3 and sys.argv[1] == "--dns-selftest":
+        exit(0 if captive_dns_selftest(int(sys.argv[2])) else 1)
+    
     # Ensure running as root
     if os.geteuid() != 0:
         print("This script must be run as root")
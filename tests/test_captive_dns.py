@@ -0,0 +1,94 @@
+"""Wildcard captive DNS responder tests"""
+import os
+import struct
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from wifi_manager import (  # noqa: E402
+    CAPTIVE_DNS_TTL, CaptiveDNSServer, build_captive_dns_response, captive_dns_lookup,
+)
+
+ADDRESS = "192.168.4.1"
+QNAME = b"\x0cconnectivity\x05check\x07example\x00"
+
+
+def make_query(qtype=1, flags=0x0100, qname=QNAME, arcount=0, extra=b""):
+    header = struct.pack("!HHHHHH", 0x1234, flags, 1, 0, 0, arcount)
+    return header + qname + struct.pack("!HH", qtype, 1) + extra
+
+
+def parse_header(response):
+    return struct.unpack("!HHHHHH", response[:12])
+
+
+def test_a_query_gets_one_record():
+    query = make_query()
+    response = build_captive_dns_response(query, ADDRESS)
+    txid, flags, qdcount, ancount, nscount, arcount = parse_header(response)
+    assert txid == 0x1234
+    assert flags & 0x8000 and flags & 0x0100  # QR set, RD echoed
+    assert flags & 0xF == 0
+    assert (qdcount, ancount, nscount, arcount) == (1, 1, 0, 0)
+    assert response[12:len(query)] == query[12:]
+
+    pointer, rtype, rclass, ttl, rdlength = struct.unpack("!HHHIH", response[len(query):len(query) + 12])
+    assert (pointer, rtype, rclass, ttl, rdlength) == (0xC00C, 1, 1, CAPTIVE_DNS_TTL, 4)
+    assert response[len(query) + 12:] == bytes([192, 168, 4, 1])
+
+
+def test_aaaa_query_gets_empty_noerror():
+    query = make_query(qtype=28)
+    response = build_captive_dns_response(query, ADDRESS)
+    _, flags, qdcount, ancount, _, _ = parse_header(response)
+    assert flags & 0xF == 0
+    assert (qdcount, ancount) == (1, 0)
+    assert len(response) == len(query)
+
+
+def test_nonzero_opcode_gets_notimp():
+    response = build_captive_dns_response(make_query(flags=2 << 11), ADDRESS)
+    _, flags, qdcount, ancount, _, _ = parse_header(response)
+    assert flags & 0xF == 4
+    assert (flags >> 11) & 0xF == 2
+    assert (qdcount, ancount) == (0, 0)
+    assert len(response) == 12
+
+
+def test_truncated_qname_is_dropped():
+    assert build_captive_dns_response(make_query()[:20], ADDRESS) is None
+    assert build_captive_dns_response(make_query()[:-1], ADDRESS) is None
+    assert build_captive_dns_response(make_query()[:11], ADDRESS) is None
+
+
+def test_compression_pointer_in_question_is_dropped():
+    assert build_captive_dns_response(make_query(qname=b"\x03www\xc0\x0c"), ADDRESS) is None
+
+
+def test_response_packet_is_dropped():
+    assert build_captive_dns_response(make_query(flags=0x8100), ADDRESS) is None
+
+
+def test_edns_query_is_answered_without_opt_record():
+    opt = b"\x00" + struct.pack("!HHIH", 41, 4096, 0, 0)
+    query = make_query(arcount=1, extra=opt)
+    response = build_captive_dns_response(query, ADDRESS)
+    _, flags, qdcount, ancount, _, arcount = parse_header(response)
+    assert flags & 0xF == 0
+    assert (qdcount, ancount, arcount) == (1, 1, 0)
+    # Only the question is echoed, the OPT record is not
+    assert response[12:12 + len(QNAME) + 4] == query[12:12 + len(QNAME) + 4]
+    assert response.endswith(bytes([192, 168, 4, 1]))
+
+
+def test_responder_answers_stub_client():
+    server = CaptiveDNSServer("127.0.0.1", 0, ADDRESS)
+    port = server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        assert captive_dns_lookup("connectivitycheck.gstatic.com", "127.0.0.1", port) == (0, [ADDRESS])
+        assert captive_dns_lookup("example.com.", "127.0.0.1", port, qtype=28) == (0, [])
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,62 @@
+"""Channel scoring tests against recorded nmcli scan output"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from wifi_manager import AP_CHANNELS, channel_overlap, parse_channel_scan, score_channels  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def load_scan(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return parse_channel_scan(f.read())
+
+
+def best(scan, candidates=AP_CHANNELS):
+    _, band, channel = score_channels(scan, candidates)[0]
+    return band, channel
+
+
+def test_parse_recorded_scan():
+    scan = load_scan("nmcli_chan_signal_busy.txt")
+    assert len(scan) == 19
+    assert scan[0] == (1, 92)
+    assert scan[-1] == (149, 33)
+
+
+def test_parse_skips_malformed_lines():
+    assert parse_channel_scan("6:50\n--:\n:40\n11:\n\n") == [(6, 50)]
+
+
+def test_busy_scan_prefers_quietest_5ghz_channel():
+    # 40 and 48 tie; the first in AP_CHANNELS order wins
+    assert best(load_scan("nmcli_chan_signal_busy.txt")) == ("a", 40)
+
+
+def test_busy_scan_without_5ghz_picks_channel_11():
+    scan = load_scan("nmcli_chan_signal_busy.txt")
+    assert best(scan, {"bg": AP_CHANNELS["bg"]}) == ("bg", 11)
+
+
+def test_strong_2ghz_neighbours_push_to_5ghz():
+    assert best([(1, 90), (1, 80), (6, 20), (11, 50), (36, 70)]) == ("a", 40)
+
+
+def test_empty_scan_picks_first_candidate():
+    assert best([]) == ("bg", 1)
+
+
+def test_results_sorted_best_first():
+    scores = [score for score, _, _ in score_channels(load_scan("nmcli_chan_signal_busy.txt"), AP_CHANNELS)]
+    assert scores == sorted(scores)
+
+
+def test_channel_overlap():
+    assert channel_overlap(6, 6) == 1.0
+    assert channel_overlap(1, 3) == 0.6
+    assert channel_overlap(1, 6) == 0.0
+    assert channel_overlap(36, 40) == 0.5
+    assert channel_overlap(48, 52) == 0.0
+    assert channel_overlap(1, 36) == 0.0
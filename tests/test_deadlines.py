@@ -0,0 +1,71 @@
+"""Deadline budget and cancellation tests"""
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import wifi_manager  # noqa: E402
+from wifi_manager import OperationCancelled, check_cancelled, deadline, run, time_left  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def reset_state(monkeypatch):
+    monkeypatch.setattr(wifi_manager, "_deadline", None)
+    monkeypatch.setattr(wifi_manager, "_cancel_requested", False)
+    monkeypatch.setattr(wifi_manager, "_stopping", False)
+
+
+def test_nested_deadline_never_extends_outer():
+    with deadline(5):
+        outer = wifi_manager._deadline
+        with deadline(60):
+            assert wifi_manager._deadline == outer
+            assert time_left() <= 5
+        with deadline(1):
+            assert wifi_manager._deadline < outer
+        assert wifi_manager._deadline == outer
+    assert wifi_manager._deadline is None
+
+
+def test_run_inside_budget():
+    with deadline(10):
+        result = run("true")
+    assert result is not None and result.returncode == 0
+
+
+def test_run_returns_none_once_budget_spent():
+    with deadline(0.01):
+        time.sleep(0.02)
+        assert time_left() <= 0
+        assert run("true") is None
+
+
+@pytest.mark.parametrize("flag", ["_cancel_requested", "_stopping"])
+def test_run_returns_none_when_cancelled(monkeypatch, flag):
+    monkeypatch.setattr(wifi_manager, flag, True)
+    assert run("true") is None
+
+
+def test_cancellation_during_command_returns_none(monkeypatch):
+    # Cancelled between Popen and the command finishing, as a signal would
+    real_popen = wifi_manager.subprocess.Popen
+
+    def popen_then_cancel(*args, **kwargs):
+        proc = real_popen(*args, **kwargs)
+        wifi_manager._cancel_requested = True
+        return proc
+
+    monkeypatch.setattr(wifi_manager.subprocess, "Popen", popen_then_cancel)
+    start = time.monotonic()
+    assert run("sleep 10") is None
+    assert time.monotonic() - start < 5
+
+
+def test_check_cancelled_raises():
+    check_cancelled()
+    wifi_manager._cancel_requested = True
+    with pytest.raises(OperationCancelled):
+        check_cancelled()
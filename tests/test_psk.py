@@ -0,0 +1,38 @@
+"""WPA PSK derivation tests for the manager and the portal"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+pytest.importorskip("flask")
+
+import config_portal  # noqa: E402
+import wifi_manager  # noqa: E402
+
+# IEEE 802.11i-2004, Annex H.4
+IEEE_PSK = "f42c6fc52df0ebef9ebb4b90b38a5f902e83fe1b135a70e23aed762e9710a12e"
+HEX_KEY = "ab" * 32
+
+
+@pytest.fixture(params=[wifi_manager, config_portal], ids=["wifi_manager", "config_portal"])
+def module(request, monkeypatch):
+    monkeypatch.setattr(request.param, "PRECOMPUTE_PSK", True)
+    return request.param
+
+
+def test_ieee_vector(module):
+    assert module.derive_psk("IEEE", "password") == IEEE_PSK
+    assert module.psk_for("IEEE", "password") == IEEE_PSK
+
+
+@pytest.mark.parametrize("passphrase", [HEX_KEY, "pässwörd123", "short"])
+def test_invalid_passphrases_pass_through(module, passphrase):
+    assert module.derive_psk("IEEE", passphrase) is None
+    assert module.psk_for("IEEE", passphrase) == passphrase
+
+
+def test_disabled_stores_passphrase(module, monkeypatch):
+    monkeypatch.setattr(module, "PRECOMPUTE_PSK", False)
+    assert module.psk_for("IEEE", "password") == "password"
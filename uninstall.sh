@@ -130,6 +130,13 @@ else
     echo "  • wifi-powersave.conf not found"
 fi
 
+if [ -f "/etc/NetworkManager/dnsmasq-shared.d/pifi-captive-dns.conf" ]; then
+    rm -f /etc/NetworkManager/dnsmasq-shared.d/pifi-captive-dns.conf
+    echo "  ✓ Removed pifi-captive-dns.conf"
+else
+    echo "  • pifi-captive-dns.conf not found"
+fi
+
 # Remove empty conf.d directory if it exists and is empty
 if [ -d "/etc/NetworkManager/conf.d" ] && [ -z "$(ls -A /etc/NetworkManager/conf.d)" ]; then
     rmdir /etc/NetworkManager/conf.d 2>/dev/null || true